@@ -0,0 +1,25 @@
+-- Materialized view for the hashR lookup analyzer of Timesketch.
+--
+-- The view pre-joins samples_sources with sources and pre-computes the
+-- "reponame:sourceid" string that the analyzer adds as the
+-- hashR_sample_sources attribute. If the view exists in the hashR database
+-- the analyzer queries it instead of joining both tables for every batch.
+--
+-- Create the view once in the hashR database:
+--   psql -d hashr -f hashr_samples_sources_enriched.sql
+--
+-- Refresh it after every hashR run, e.g. from a cron job:
+--   psql -d hashr -c 'REFRESH MATERIALIZED VIEW CONCURRENTLY samples_sources_enriched;'
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS samples_sources_enriched AS
+SELECT
+  ss.sample_sha256,
+  ss.source_sha256,
+  s.reponame || ':' || array_to_string(s.sourceid, ';') AS source_key
+FROM samples_sources ss
+JOIN sources s ON ss.source_sha256 = s.sha256;
+
+-- The unique index is required by REFRESH ... CONCURRENTLY and covers the
+-- lookups by sample_sha256.
+CREATE UNIQUE INDEX IF NOT EXISTS ix_samples_sources_enriched_sample_source
+  ON samples_sources_enriched (sample_sha256, source_sha256);
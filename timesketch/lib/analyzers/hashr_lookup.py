@@ -1,9 +1,15 @@
 """Sketch analyzer plugin for hashR lookup."""
 
+import collections
+import io
+import itertools
 import logging
-import sys
+import re
+import threading
+import time
 
-from math import ceil
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional, Union
 from flask import current_app
 import sqlalchemy as sqla
@@ -12,6 +18,118 @@ from timesketch.lib.analyzers import interface, manager
 logger = logging.getLogger("timesketch.analyzers.hashR")
 
 
+class HashRConfigError(Exception):
+    """An error raised when the hashR database cannot be used."""
+
+
+# Database engines and reflected schemas are shared by all analyzer runs in
+# a worker process, so the connection pool survives between runs.
+_ENGINE_LOCK = threading.Lock()
+_ENGINES = {}
+_META_DATA = {}
+
+# The sha256 hash of an empty file and the tags used for known hashes.
+_ZEROBYTE_SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+_TAGS_KNOWN = ("known-hash",)
+_TAGS_ZEROBYTE = ("known-hash", "zerobyte-file")
+_IS_SHA256 = re.compile(r"[0-9a-fA-F]{64}\Z").match
+
+# Recent lookup results, shared by all analyzer runs in a worker process.
+# Common hashes (system binaries etc.) recur across many sketches, so known
+# results, including misses, are not sent to the hashR database again.
+_HASH_CACHE_SIZE = 200000
+_HASH_CACHE_TTL = 3600
+_HASH_CACHE_LOCK = threading.Lock()
+_HASH_CACHES = {}
+
+
+def _get_hash_cache(cache_key):
+    """Return the lookup cache for the given database and lookup type.
+
+    Args:
+      cache_key: A hashable key that identifies the database and the kind of
+                 lookup, since results with and without sources differ.
+
+    Returns:
+      An OrderedDict that maps hashes to (expiry time, sources) tuples, where
+      sources is a frozenset or None for hashes not known in hashR.
+    """
+    with _HASH_CACHE_LOCK:
+        return _HASH_CACHES.setdefault(cache_key, collections.OrderedDict())
+
+
+def _lookup_cached_hashes(cache, sample_hashes):
+    """Split the hashes into cached results and hashes to look up.
+
+    Args:
+      cache: The lookup cache returned by _get_hash_cache.
+      sample_hashes: An iterable of hashes.
+
+    Returns:
+      A tuple of a dict with the cached sources of known hashes and a list of
+      the unique hashes not found in the cache.
+    """
+    cached_matches = {}
+    unknown_hashes = []
+    now = time.monotonic()
+    with _HASH_CACHE_LOCK:
+        # Drop duplicates, the temporary table lookup requires unique hashes.
+        for sample_hash in dict.fromkeys(sample_hashes):
+            entry = cache.get(sample_hash)
+            if entry is None or entry[0] < now:
+                unknown_hashes.append(sample_hash)
+                continue
+            cache.move_to_end(sample_hash)
+            if entry[1] is not None:
+                cached_matches[sample_hash] = set(entry[1])
+    return cached_matches, unknown_hashes
+
+
+def _cache_lookup_results(cache, sample_hashes, matching_hashes):
+    """Store the lookup results of the hashes in the cache.
+
+    Args:
+      cache: The lookup cache returned by _get_hash_cache.
+      sample_hashes: The hashes that were looked up.
+      matching_hashes: A dict with the sources of the hashes found in hashR.
+    """
+    expires = time.monotonic() + _HASH_CACHE_TTL
+    with _HASH_CACHE_LOCK:
+        for sample_hash in sample_hashes:
+            sources = matching_hashes.get(sample_hash)
+            cache[sample_hash] = (
+                expires,
+                None if sources is None else frozenset(sources),
+            )
+            cache.move_to_end(sample_hash)
+        while len(cache) > _HASH_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _get_engine(db_string):
+    """Return the process wide engine for the given hashR database.
+
+    Args:
+      db_string: The connection string of the hashR database.
+
+    Returns:
+      A SQLAlchemy engine with a connection pool.
+    """
+    with _ENGINE_LOCK:
+        engine = _ENGINES.get(db_string)
+        if engine is None:
+            engine = sqla.create_engine(
+                db_string,
+                pool_size=10,
+                max_overflow=20,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+                connect_args={"connect_timeout": 10},
+            )
+            _ENGINES[db_string] = engine
+        return engine
+
+
 class HashRLookup(interface.BaseAnalyzer):
     """Analyzer for HashRLookup."""
 
@@ -28,9 +146,29 @@ class HashRLookup(interface.BaseAnalyzer):
     known_hash_event_counter = 0
     unique_known_hash_counter = 0
     hashr_conn = None
+    samples_table = None
+    sources_table = None
+    samples_sources_table = None
+    samples_sources_view = None
     add_source_attribute = None
     query_batch_size = None
-    DEFAULT_BATCH_SIZE = 50000
+    array_bind = True
+    DEFAULT_BATCH_SIZE = 10000
+    # PostgreSQL accepts at most 32767 bind parameters per statement. Without
+    # array binding every hash in a batch is its own parameter.
+    MAX_PARAMETER_BATCH_SIZE = 32000
+    # Batches above this size are joined against a VALUES list instead of
+    # using an IN clause, when array binding is disabled.
+    VALUES_JOIN_THRESHOLD = 200
+    # Number of batches that are queried in parallel.
+    QUERY_WORKERS = 8
+    # Number of rows fetched at once from the server side cursor.
+    QUERY_YIELD_PER = 1000
+    # Number of matching events fetched per multi get request.
+    FETCH_BATCH_SIZE = 1000
+    # Lookups of more hashes than this are copied into a temporary table and
+    # resolved with a single join (psycopg2 only).
+    COPY_THRESHOLD = 50000
 
     def __init__(self, index_name, sketch_id, timeline_id=None):
         """Initialize The Sketch Analyzer.
@@ -50,9 +188,10 @@ class HashRLookup(interface.BaseAnalyzer):
           True: If connection is setup and successfully tested.
 
         Raises:
-          Exception:  Raises an exception if the database connection details
-                      cannot be loaded from the timesketch.conf file.
-          Exception: If the connection cannot be setup or tested.
+          HashRConfigError: If the database connection details cannot be
+                            loaded from the timesketch.conf file, the
+                            connection cannot be setup or tested or the
+                            required tables are missing.
         """
 
         # Note: Provide connection infos in the data/timesketch.conf file!
@@ -65,6 +204,19 @@ class HashRLookup(interface.BaseAnalyzer):
         self.query_batch_size = int(
             current_app.config.get("HASHR_QUERY_BATCH_SIZE", self.DEFAULT_BATCH_SIZE)
         )
+        self.array_bind = current_app.config.get("HASHR_ARRAY_BIND", True)
+        if (
+            not self.array_bind
+            and self.query_batch_size > self.MAX_PARAMETER_BATCH_SIZE
+        ):
+            logger.warning(
+                "The configured HASHR_QUERY_BATCH_SIZE (%d) exceeds the maximum "
+                "of %d hashes per query without HASHR_ARRAY_BIND. Using %d.",
+                self.query_batch_size,
+                self.MAX_PARAMETER_BATCH_SIZE,
+                self.MAX_PARAMETER_BATCH_SIZE,
+            )
+            self.query_batch_size = self.MAX_PARAMETER_BATCH_SIZE
 
         if not all(
             config_param
@@ -83,8 +235,7 @@ class HashRLookup(interface.BaseAnalyzer):
                 " to uncomment the section and provide the required "
                 "connection details!"
             )
-            sys.tracebacklimit = 0
-            raise Exception(msg)  # pylint: disable=broad-exception-raised
+            raise HashRConfigError(msg)
 
         db_string = (
             f"postgresql://{db_user}:{db_pass}@" f"{db_address}:{db_port}/{db_name}"
@@ -92,9 +243,10 @@ class HashRLookup(interface.BaseAnalyzer):
         db_string_redacted = (
             f"postgresql://{db_user}:***@" f"{db_address}:{db_port}/{db_name}"
         )
-        db = sqla.create_engine(db_string, connect_args={"connect_timeout": 10})
+        db = _get_engine(db_string)
         try:
-            db.connect()
+            with db.connect():
+                pass
             logger.debug(
                 "Successful connected to hashR postgresql database: %s",
                 db_string_redacted,
@@ -104,17 +256,16 @@ class HashRLookup(interface.BaseAnalyzer):
             msg = (
                 "Connection to the hashR postgres database failed! "
                 '-- Provided connection string: "%s" '
-                "-- Error message: %s",
-                db_string_redacted,
-                str(err),
+                "-- Error message: %s"
             )
-            logger.error(msg)
-            sys.tracebacklimit = 0
-            raise Exception(msg) from err  # pylint: disable=broad-exception-raised
+            logger.error(msg, db_string_redacted, str(err))
+            raise HashRConfigError(msg % (db_string_redacted, str(err))) from err
 
         # Check if the required tables are present in the hashR database
-        meta_data = sqla.MetaData(bind=self.hashr_conn)
-        sqla.MetaData.reflect(meta_data)
+        meta_data = _META_DATA.get(db_string)
+        if meta_data is None:
+            meta_data = sqla.MetaData(bind=self.hashr_conn)
+            sqla.MetaData.reflect(meta_data, views=True)
         if not all(
             table_name in meta_data.tables
             for table_name in ["samples", "sources", "samples_sources"]
@@ -122,31 +273,210 @@ class HashRLookup(interface.BaseAnalyzer):
             msg = (
                 "Could not find the required tables in the hashR database! "
                 "Please ensure you have populated your hashR database using "
-                "the most recent hashR project version!"
-                "Required tables: samples, sources, samples_sources",
+                "the most recent hashR project version! "
+                "Required tables: samples, sources, samples_sources"
             )
             logger.error(msg)
-            sys.tracebacklimit = 0
-            raise Exception(msg) from KeyError  # pylint: disable=broad-exception-raised
+            raise HashRConfigError(msg)
+
+        # Keep the reflected tables, the schema does not change between runs.
+        if db_string not in _META_DATA:
+            self.check_sample_hash_index()
+            _META_DATA[db_string] = meta_data
+        self.samples_table = meta_data.tables["samples"]
+        self.sources_table = meta_data.tables["sources"]
+        self.samples_sources_table = meta_data.tables["samples_sources"]
+        # Optional materialized view with pre-computed sources, see
+        # contrib/hashr_samples_sources_enriched.sql
+        self.samples_sources_view = meta_data.tables.get("samples_sources_enriched")
 
         return True
 
-    def batch_hashes(self, hash_list, batch_size=DEFAULT_BATCH_SIZE):
-        """Generator function for slicing the hash list into batches
+    def check_sample_hash_index(self):
+        """Make sure the sample hashes in samples_sources are indexed.
+
+        Every lookup filters samples_sources by sample_sha256, without an
+        index on that column each batch results in a full table scan. If the
+        index is missing, this tries to create it and logs a warning if that
+        is not possible. Invalid indexes are not rebuilt automatically, a
+        warning with the statements to fix them is logged instead.
+
+        Returns:
+          True: If a valid index exists or was created, otherwise False.
+        """
+        # A multicolumn index starting with sample_sha256 works as well.
+        # pg_indexes also lists invalid indexes, e.g. left behind by an
+        # interrupted CREATE INDEX CONCURRENTLY, so check pg_index instead.
+        index_query = sqla.text(
+            "SELECT i.relname, x.indisvalid FROM pg_index x "
+            "JOIN pg_class i ON i.oid = x.indexrelid "
+            "JOIN pg_class t ON t.oid = x.indrelid "
+            "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0] "
+            "WHERE t.relname = 'samples_sources' AND a.attname = 'sample_sha256'"
+        )
+        with self.hashr_conn.connect() as conn:
+            indexes = conn.execute(index_query).fetchall()
+        if any(is_valid for _, is_valid in indexes):
+            return True
+
+        if indexes:
+            for index_name, _ in indexes:
+                logger.warning(
+                    "The index %s on samples_sources.sample_sha256 is invalid, "
+                    "most likely because building it was interrupted. Lookups "
+                    "will be slow! Please rebuild it with: REINDEX INDEX "
+                    "CONCURRENTLY %s; -- or drop it with: DROP INDEX "
+                    "CONCURRENTLY %s; and run the analyzer again to recreate it.",
+                    index_name,
+                    index_name,
+                    index_name,
+                )
+            return False
+
+        logger.warning(
+            "The hashR table samples_sources has no index on the column "
+            "sample_sha256. Trying to create it now."
+        )
+        try:
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+            with self.hashr_conn.connect() as conn:
+                conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+                    sqla.text(
+                        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                        "ix_samples_sources_sample_sha256 "
+                        "ON samples_sources (sample_sha256)"
+                    )
+                )
+        except sqla.exc.SQLAlchemyError as err:
+            logger.warning(
+                "Unable to create the index on samples_sources.sample_sha256, "
+                "lookups will be slow! Please create it with: CREATE INDEX "
+                "ix_samples_sources_sample_sha256 ON samples_sources "
+                "(sample_sha256); -- Error message: %s",
+                str(err),
+            )
+            return False
+
+        logger.info("Created the index on samples_sources.sample_sha256.")
+        return True
+
+    def batch_hashes(self, hashes, batch_size=DEFAULT_BATCH_SIZE):
+        """Generator function for slicing the hash values into batches
 
         Args:
-          hash_list: A list of hash values.
+          hashes: An iterable of hash values.
           batch_size: Size of each batch. Default defined in class var.
         """
-        for i in range(0, len(hash_list), batch_size):
-            yield hash_list[i : i + batch_size]
+        hash_iterator = iter(hashes)
+        while True:
+            batch = list(itertools.islice(hash_iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def build_values_statement(self, base_statement, hash_column, batch):
+        """Build the lookup statement for a large batch without array binding.
+
+        The batch is joined against an inline VALUES list, which lets the
+        planner treat the hashes as a relation instead of a long list of
+        scalars.
+
+        Args:
+          base_statement: The select statement without a hash filter.
+          hash_column: The column that holds the sha256 hash values.
+          batch: A list of hash values.
+
+        Returns:
+          The select statement for the given batch.
+        """
+        values_clause = sqla.values(sqla.column("h", sqla.Text), name="v").data(
+            [(hash_value,) for hash_value in batch]
+        )
+        return base_statement.join(values_clause, hash_column == values_clause.c.h)
+
+    def _query_batch(self, select_statement, parameters=None):
+        """Run a single batch lookup on its own pooled connection.
+
+        Args:
+          select_statement: The select statement for the batch.
+          parameters: Optional dict of bind parameters for the statement.
+
+        Returns:
+          A dict with the matching hashes of this batch and their sources.
+        """
+        with self.hashr_conn.connect() as conn:
+            # Stream the rows with a server side cursor instead of fetching
+            # all matches of the batch into memory first.
+            results = conn.execution_options(
+                stream_results=True, yield_per=self.QUERY_YIELD_PER
+            ).execute(select_statement, parameters or {})
+            return self._collect_matches(results)
+
+    def _query_temp_table(self, base_statement, hash_column, hashes):
+        """Look up a large number of hashes with a single query.
 
-    def check_against_hashr(self, sample_hashes: list):
-        """Check a list of hashes against the hashR database.
+        The hashes are copied into a temporary table with COPY, which is
+        much cheaper than binding them as parameters. The table is dropped
+        at the end of the transaction.
 
         Args:
-          sample_hashes:  A list of hash values that shall be checked
-                          against the hashR database.
+          base_statement (sqla.sql.Select): The select statement without a
+                                            hash filter.
+          hash_column (sqla.Column): The column that holds the sha256 hash
+                                     values.
+          hashes (list): The unique hash values to look up.
+
+        Returns:
+          A dict with the matching hashes and their sources.
+        """
+        probe_table = sqla.table("hashr_probe", sqla.column("h", sqla.Text))
+        select_statement = base_statement.join(
+            probe_table, hash_column == probe_table.c.h
+        )
+        with self.hashr_conn.begin() as conn:
+            conn.execute(
+                sqla.text(
+                    "CREATE TEMP TABLE hashr_probe (h TEXT PRIMARY KEY) ON COMMIT DROP"
+                )
+            )
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    "COPY hashr_probe (h) FROM STDIN", io.StringIO("\n".join(hashes))
+                )
+            finally:
+                cursor.close()
+            # Give the planner row estimates for the join.
+            conn.execute(sqla.text("ANALYZE hashr_probe"))
+            results = conn.execution_options(
+                stream_results=True, yield_per=self.QUERY_YIELD_PER
+            ).execute(select_statement)
+            return self._collect_matches(results)
+
+    def _collect_matches(self, results):
+        """Collect the matching hashes from the rows of a lookup query.
+
+        Args:
+          results: The result rows of a lookup statement.
+
+        Returns:
+          A dict with the matching hashes and their sources.
+        """
+        matches = {}
+        if not self.add_source_attribute:
+            for (sample_hash,) in results:
+                matches[sample_hash] = {"TagsOnly"}
+        else:
+            for sample_hash, sources in results:
+                matches[sample_hash] = set(sources)
+        return matches
+
+    def check_against_hashr(self, sample_hashes: Iterable[str]):
+        """Check a collection of hashes against the hashR database.
+
+        Args:
+          sample_hashes:  An iterable (e.g. list or dict keys) of hash values
+                          that shall be checked against the hashR database.
 
         Returns:
           matching_hashes:  A dict containing all hashes that are found in the
@@ -155,80 +485,162 @@ class HashRLookup(interface.BaseAnalyzer):
           None:             If there are no matches, the function returns None.
 
         Raises:
-          Exception:  Raises an exception if the provided sample_hashes
-                      parameter is not of type list or dict.
+          TypeError:  If the provided sample_hashes parameter is a string or
+                      not iterable.
         """
-        if not isinstance(sample_hashes, list):
-            raise Exception(  # pylint: disable=broad-exception-raised
-                "The check_against_hashR function only accepts "
-                "type<list> as input. But type "
+        if isinstance(sample_hashes, str) or not isinstance(sample_hashes, Iterable):
+            raise TypeError(
+                "The check_against_hashR function only accepts an "
+                "iterable of hashes as input. But type "
                 f"{type(sample_hashes)} was provided!"
             )
 
-        meta_data = sqla.MetaData(bind=self.hashr_conn)
-        sqla.MetaData.reflect(meta_data)
-        samples_table = meta_data.tables["samples"]
-        sources_table = meta_data.tables["sources"]
-        samples_sources_table = meta_data.tables["samples_sources"]
-
-        matching_hashes = {}
-
-        with self.hashr_conn.connect() as conn:
-            batch_counter = 1
-            total_batches = ceil(len(sample_hashes) / self.query_batch_size)
-            for batch in self.batch_hashes(sample_hashes, self.query_batch_size):
-                logger.debug(
-                    "Processing %d/%d batches...", batch_counter, total_batches
+        samples_table = self.samples_table
+        sources_table = self.sources_table
+        samples_sources_table = self.samples_sources_table
+
+        # With sources, the matches are aggregated per hash in the database,
+        # so each matching hash is returned as a single row with a text[] of
+        # its sources.
+        if self.add_source_attribute and self.samples_sources_view is not None:
+            # The view already joins both tables and contains the source
+            # string, so no join is needed.
+            samples_sources_view = self.samples_sources_view
+            hash_column = samples_sources_view.c.sample_sha256
+            base_statement = (
+                sqla.select(
+                    [
+                        hash_column,
+                        sqla.func.array_agg(
+                            sqla.distinct(samples_sources_view.c.source_key)
+                        ).label("sources"),
+                    ]
                 )
-                batch_counter += 1
-
-                if self.add_source_attribute:
-                    select_statement = (
-                        sqla.select(
-                            [
-                                samples_sources_table.c.sample_sha256,
-                                samples_sources_table.c.source_sha256,
-                                sources_table.c.sourceid,
-                                sources_table.c.reponame,
-                            ]
-                        )
-                        .select_from(
-                            samples_sources_table.join(
-                                sources_table,
-                                samples_sources_table.c.source_sha256
-                                == sources_table.c.sha256,
-                            )
-                        )
-                        .where(samples_sources_table.c.sample_sha256.in_(batch))
+                .select_from(samples_sources_view)
+                .group_by(hash_column)
+            )
+        elif self.add_source_attribute:
+            hash_column = samples_sources_table.c.sample_sha256
+            sourceid = sources_table.c.sourceid
+            if isinstance(sourceid.type, sqla.ARRAY):
+                # hashR stores the source IDs as a text[] column.
+                sourceid = sqla.func.array_to_string(sourceid, ";", type_=sqla.Text)
+            base_statement = (
+                sqla.select(
+                    [
+                        hash_column,
+                        sqla.func.array_agg(
+                            sqla.distinct(sources_table.c.reponame + ":" + sourceid)
+                        ).label("sources"),
+                    ]
+                )
+                .select_from(
+                    samples_sources_table.join(
+                        sources_table,
+                        samples_sources_table.c.source_sha256 == sources_table.c.sha256,
                     )
+                )
+                .group_by(hash_column)
+            )
+        else:
+            hash_column = samples_table.c.sha256
+            base_statement = sqla.select([samples_table.c.sha256]).select_from(
+                samples_table
+            )
 
-                    results = conn.execute(select_statement)
+        # Bind each batch as a single text[] parameter so the statement text
+        # stays the same for every batch, regardless of the batch size.
+        hashes_param = sqla.bindparam("hashes", type_=sqla.ARRAY(sqla.Text))
+        select_statement = base_statement.where(hash_column == sqla.any_(hashes_param))
+        # Without array binding, small batches share a single statement with
+        # an expanding IN parameter, so it is only built and compiled once.
+        in_statement = base_statement.where(
+            hash_column.in_(sqla.bindparam("hashes", expanding=True))
+        )
+
+        hash_cache = _get_hash_cache((self.hashr_conn, self.add_source_attribute))
+        matching_hashes, unknown_hashes = _lookup_cached_hashes(
+            hash_cache, sample_hashes
+        )
+        logger.debug("%d hashes not in the lookup cache.", len(unknown_hashes))
 
-                else:
-                    select_statement = sqla.select([samples_table.c.sha256]).where(
-                        samples_table.c.sha256.in_(batch)
+        if (
+            len(unknown_hashes) > self.COPY_THRESHOLD
+            and self.hashr_conn.dialect.driver == "psycopg2"
+        ):
+            found_hashes = self._query_temp_table(
+                base_statement, hash_column, unknown_hashes
+            )
+        else:
+            found_hashes = {}
+            with ThreadPoolExecutor(max_workers=self.QUERY_WORKERS) as executor:
+                futures = []
+                for batch in self.batch_hashes(unknown_hashes, self.query_batch_size):
+                    if self.array_bind:
+                        statement, parameters = select_statement, {"hashes": batch}
+                    elif len(batch) > self.VALUES_JOIN_THRESHOLD:
+                        statement = self.build_values_statement(
+                            base_statement, hash_column, batch
+                        )
+                        parameters = None
+                    else:
+                        statement, parameters = in_statement, {"hashes": batch}
+                    futures.append(
+                        executor.submit(self._query_batch, statement, parameters)
                     )
 
-                    results = conn.execute(select_statement)
+                for batch_counter, future in enumerate(as_completed(futures), 1):
+                    logger.debug(
+                        "Processed %d/%d batches...", batch_counter, len(futures)
+                    )
+                    # Every hash is part of a single batch only.
+                    found_hashes.update(future.result())
 
-                for entry in results:
-                    sample_hash = entry[0]
-                    try:
-                        if isinstance(entry[2], list):
-                            source = f'{entry[3]}:{";".join(entry[2])}'
-                        else:
-                            source = f"{entry[3]}:{entry[2]}"
-                    except (IndexError, sqla.exc.NoSuchColumnError):
-                        source = "TagsOnly"
-                    matching_hashes.setdefault(sample_hash, set()).add(source)
+        _cache_lookup_results(hash_cache, unknown_hashes, found_hashes)
+        matching_hashes.update(found_hashes)
 
         logger.debug("Found %d matching hashes in hashR DB.", len(matching_hashes))
-
-        # close database engine
-        self.hashr_conn.dispose()
-        logger.debug("Closed database connection.")
         return matching_hashes
 
+    def fetch_events(self, matching_hashes, hash_events):
+        """Fetch the events that contain one of the matching hashes.
+
+        Args:
+          matching_hashes (Iterable[str]): The hashes that are known in hashR.
+          hash_events (dict): Maps each hash value to a list of event ID and
+                              index name tuples of the events that contain it.
+
+        Yields:
+          Tuples of the hash value and the interface.Event that contains it.
+        """
+        event_refs = (
+            (sample_hash, event_ref)
+            for sample_hash in matching_hashes
+            for event_ref in hash_events[sample_hash]
+        )
+        for batch in self.batch_hashes(event_refs, self.FETCH_BATCH_SIZE):
+            docs = [
+                {"_index": index_name, "_id": event_id}
+                for _, (event_id, index_name) in batch
+            ]
+            # Only the tags are needed to annotate the events.
+            # pylint: disable=unexpected-keyword-arg
+            response = self.datastore.client.mget(
+                body={"docs": docs}, _source_includes=["tag"]
+            )
+            # The docs are returned in the same order as requested.
+            for (sample_hash, _), doc in zip(batch, response["docs"]):
+                if not doc.get("found"):
+                    logger.warning(
+                        "Unable to fetch event %s from index %s.",
+                        doc.get("_id"),
+                        doc.get("_index"),
+                    )
+                    continue
+                yield sample_hash, interface.Event(
+                    doc, self.datastore, sketch=self.sketch, analyzer=self
+                )
+
     def annotate_event(
         self,
         hash_value: str,
@@ -238,29 +650,42 @@ class HashRLookup(interface.BaseAnalyzer):
         """Add tags and attributes to the given event, based on the rules for
         the analyzer.
 
+        The tags and attributes are combined into a single update, which is
+        queued in the bulk import queue of the datastore. Call _flush_updates
+        to send the remaining queued updates.
+
         Args:
           hash_value: A string of a sha256 hash value.
           sources: A list of sources (image names) where this hash is known from.
           event:  The OpenSearch event object that contains this hash and needs
                   to be tagged or to add an attribute.
         """
-        tags_container = ["known-hash"]
-        if (
-            hash_value
-            == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
-        ):
-            tags_container.append("zerobyte-file")
+        if hash_value == _ZEROBYTE_SHA256:
+            tags = _TAGS_ZEROBYTE
             self.zerobyte_file_counter += 1
             # Do not add any source attribute for zerobyte files,
             # since it exists in all sources.
             sources = False
+        else:
+            tags = _TAGS_KNOWN
 
-        event.add_tags(tags_container)
+        existing_tags = event.source.get("tag", [])
+        updated_event = {"tag": list(set(existing_tags) | set(tags))}
+        self.output.add_created_tags(tags)
 
         if sources:
-            event.add_attributes({"hashR_sample_sources": list(sources)})
+            updated_event["hashR_sample_sources"] = list(sources)
+            self.output.add_created_attributes(["hashR_sample_sources"])
+
+        # The datastore sends the queued updates in bulk requests, every
+        # OPENSEARCH_FLUSH_INTERVAL events.
+        self.datastore.import_event(
+            event.index_name, event=updated_event, event_id=event.event_id
+        )
 
-        event.commit()
+    def _flush_updates(self):
+        """Send all queued event updates to the datastore."""
+        self.datastore.flush_queued_events()
 
     def run(self):
         """Entry point for the analyzer.
@@ -269,7 +694,13 @@ class HashRLookup(interface.BaseAnalyzer):
             String with summary of the analyzer result
         """
         # Connect to the hashR database
-        self.connect_hashr()
+        try:
+            self.connect_hashr()
+        except HashRConfigError as err:
+            self.output.result_status = "ERROR"
+            self.output.result_priority = "NOTE"
+            self.output.result_summary = f"hashR database error - {err}"
+            return str(self.output)
 
         # Note: Add fieldnames that contain sha256 values in your events.
         query = (
@@ -282,7 +713,11 @@ class HashRLookup(interface.BaseAnalyzer):
 
         # Generator of events based on your query.
         # Swap for self.event_pandas to get pandas back instead of events.
-        events = self.event_stream(query_string=query, return_fields=return_fields)
+        # event_stream extends the list of fields, pass a copy to only look
+        # at the hash fields below.
+        events = self.event_stream(
+            query_string=query, return_fields=list(return_fields)
+        )
         known_hash_counter = 0
         error_hash_counter = 0
         total_event_counter = 0
@@ -290,11 +725,10 @@ class HashRLookup(interface.BaseAnalyzer):
         logger.debug("Collecting a list of unique hashes to check against hashR.")
         for event in events:
             total_event_counter += 1
-            hash_value = None
-            for key in return_fields:
-                if key in event.source.keys():
-                    hash_value = event.source.get(key)
-                    break
+            source = event.source
+            hash_value = next(
+                (source[key] for key in return_fields if key in source), None
+            )
             if not hash_value:
                 error_hash_counter += 1
                 logger.warning(
@@ -304,18 +738,24 @@ class HashRLookup(interface.BaseAnalyzer):
                 )
                 continue
 
-            if len(hash_value) != 64:
+            if not isinstance(hash_value, str) or not _IS_SHA256(hash_value):
                 logger.warning(
-                    "The extracted hash does not match the required "
-                    "length (64) of a SHA256 hash. Skipping this "
+                    "The extracted hash is not a valid SHA256 hash "
+                    "(64 hexadecimal characters). Skipping this "
                     "event! Hash: %s - Length: %d",
                     hash_value,
-                    len(hash_value),
+                    len(str(hash_value)),
                 )
                 error_hash_counter += 1
                 continue
+            # hashR stores the hashes in lowercase.
+            hash_value = hash_value.lower()
 
-            hash_events_dict.setdefault(hash_value, []).append(event)
+            # Only keep a reference, the matching events are fetched again
+            # after the lookup.
+            hash_events_dict.setdefault(hash_value, []).append(
+                (event.event_id, event.index_name)
+            )
 
         if len(hash_events_dict) <= 0:
             self.output.result_status = "SUCCESS"
@@ -331,21 +771,24 @@ class HashRLookup(interface.BaseAnalyzer):
             total_event_counter,
         )
 
-        matching_hashes = self.check_against_hashr(list(hash_events_dict.keys()))
+        matching_hashes = self.check_against_hashr(hash_events_dict.keys())
         if self.add_source_attribute:
             logger.debug("Start adding tags and attributes to events.")
-            for sample_hash, hashr_value in matching_hashes.items():
-                for event in hash_events_dict[sample_hash]:
-                    known_hash_counter += 1
-                    self.annotate_event(sample_hash, hashr_value, event)
+            for sample_hash, event in self.fetch_events(
+                matching_hashes, hash_events_dict
+            ):
+                known_hash_counter += 1
+                self.annotate_event(sample_hash, matching_hashes[sample_hash], event)
             self.unique_known_hash_counter = len(matching_hashes)
         else:
             logger.debug("Start adding tags to events.")
-            for sample_hash in matching_hashes:
-                for event in hash_events_dict[sample_hash]:
-                    known_hash_counter += 1
-                    self.annotate_event(sample_hash, False, event)
+            for sample_hash, event in self.fetch_events(
+                matching_hashes, hash_events_dict
+            ):
+                known_hash_counter += 1
+                self.annotate_event(sample_hash, False, event)
             self.unique_known_hash_counter = len(matching_hashes)
+        self._flush_updates()
 
         self.output.result_status = "SUCCESS"
         self.output.result_priority = "NOTE"